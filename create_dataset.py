@@ -5,48 +5,72 @@ Photon search with a CNN
 """
 
 
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from typing import List
+from typing import Dict, List
 from utils import ProcessedData
 
-def create_info_event(processed_data: ProcessedData) -> np.ndarray:
+def shuffle_arrays(arrays: List[np.ndarray], set_seed: int = 55) -> List[np.ndarray]:
     """
-    Create info_event for a single ProcessedData object.
+    Shuffles arrays in the same order along axis=0, using a single permutation.
 
     Parameters:
     -----------
-    processed_data : ProcessedData
-        An instance of ProcessedData containing processed data arrays.
+    arrays : List of NumPy arrays.
+        List containing arrays to be shuffled.
+    set_seed : int, optional
+        Seed value if int >= 0, else seed is random. Default is 55.
 
     Returns:
     -----------
-    np.ndarray
-        An array containing concatenated information from processed_data attributes
-        (theta, lg_S1000, Nstat).
+    List[np.ndarray]
+        New arrays gathered with the same permutation of the events.
     """
-    return np.column_stack((processed_data.theta, processed_data.lg_S1000, processed_data.Nstat))
-
+    assert all(len(arr) == len(arrays[0]) for arr in arrays)
+    seed = None if set_seed < 0 else set_seed
+    rng = np.random.Generator(np.random.PCG64(seed))
+    perm = rng.permutation(len(arrays[0]))
 
+    shuffled = []
+    for arr in arrays:
+        out = np.empty_like(arr)
+        np.take(arr, perm, axis=0, out=out)
+        shuffled.append(out)
+    return shuffled
 
-def shuffle_arrays(arrays: List[np.ndarray], set_seed: int = 55) -> None:
+def quantize_arrays(arrays: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
     """
-    Shuffles arrays in-place, in the same order, along axis=0
+    Reduce the precision of the data set arrays before saving them.
 
     Parameters:
     -----------
-    arrays : List of NumPy arrays.
-        List containing arrays to be shuffled.
-    set_seed : int, optional
-        Seed value if int >= 0, else seed is random. Default is 55.
-    """
-    assert all(len(arr) == len(arrays[0]) for arr in arrays)
-    seed = np.random.randint(0, 2**(32 - 1) - 1) if set_seed < 0 else set_seed
+    arrays : Dict[str, np.ndarray]
+        Arrays of the data set, with the same keys written in the .npz file.
 
-    for arr in arrays: 
-        rstate = np.random.RandomState(seed)
-        rstate.shuffle(arr)
+    Returns:
+    -----------
+    Dict[str, np.ndarray]
+        Arrays where traces are int16 (traces = traces_q * traces_scale), dist, Stot,
+        azimuthSP and info_event are float16 and labels are unchanged.
+    """
+    traces = arrays['traces']
+    scale = np.max(np.abs(traces)) / 32767.0
+    if scale == 0:
+        scale = 1.0
+    quantized = {}
+    for key, arr in arrays.items():
+        if key == 'traces':
+            quantized['traces'] = np.rint(traces / scale).astype(np.int16)
+            quantized['traces_scale'] = np.float64(scale)
+        elif key == 'labels':
+            quantized['labels'] = arr
+        else:
+            quantized[key] = arr.astype(np.float16)
+    return quantized
 
-def merge_and_shuffle(output_dir: str, dataset_name: str, processed_data_list: List[ProcessedData], set_seed: int = 55) -> None:
+def merge_and_shuffle(output_dir: str, dataset_name: str, processed_data_list: List[ProcessedData], set_seed: int = 55, compress: bool = False, quantize: bool = False, save_format: str = 'npz') -> None:
     """
     Merge ProcessedData objects and shuffle them while preserving the correspondence between arrays.
 
@@ -60,6 +84,15 @@ def merge_and_shuffle(output_dir: str, dataset_name: str, processed_data_list: L
         List of ProcessedData objects to be merged and shuffled.
     set_seed : int, optional
         Seed value for shuffling. Default is 55.
+    compress : bool, optional
+        If True the arrays are DEFLATE-compressed in the .npz file, otherwise they are
+        stored uncompressed, which is much faster to write. Default is False.
+    quantize : bool, optional
+        If True the traces are stored as int16 together with their scale factor (traces_scale),
+        and the other per-station arrays as float16. Default is False.
+    save_format : str, optional
+        'npz' to save a single .npz file, 'npy' to save one .npy file per array in the
+        directory output_dir/dataset_name (compress is ignored). Default is 'npz'.
 
     Returns:
     -----------
@@ -68,34 +101,69 @@ def merge_and_shuffle(output_dir: str, dataset_name: str, processed_data_list: L
     
     #processed_data_list = [data for data in processed_data_list if data.label == 1] #filter only data with label 0
 
-    # Create info_event for each ProcessedData object
-    info_events = np.concatenate([create_info_event(data) for data in processed_data_list])
-
-    # Extract relevant arrays and concatenate them along the existing axis
-    traces = np.concatenate([data.traces_cum for data in processed_data_list])
-    labels = np.concatenate([np.full_like(data.lgE_MC, data.label) for data in processed_data_list])
-    Dist_norm = np.concatenate([data.Dist for data in processed_data_list])
-    azimuth = np.concatenate([data.azimuth for data in processed_data_list])
-    lg_Stot = np.concatenate([data.lg_Stot for data in processed_data_list])
-
-    Dist_norm = Dist_norm.reshape(Dist_norm.shape[0], Dist_norm.shape[1], 1)
-    azimuth = azimuth.reshape(azimuth.shape[0], azimuth.shape[1], 1)
-    lg_Stot = lg_Stot.reshape(lg_Stot.shape[0], lg_Stot.shape[1], 1)
-    traces = traces.reshape(traces.shape[0], traces.shape[1], traces.shape[2], 1)
-    info_events = info_events.reshape(info_events.shape[0],info_events.shape[1], 1)
-    labels = labels.reshape(labels.shape[0],)
-   
+    # Merge all the ProcessedData objects in a single pass
+    stacked = ProcessedData.stack(processed_data_list)
+
     # Shuffle arrays while preserving correspondence
-    arrays = shuffle_arrays([traces, labels, Dist_norm, info_events, azimuth, lg_Stot], set_seed=set_seed)
+    traces, labels, Dist_norm, info_events, azimuth, lg_Stot = shuffle_arrays([stacked.traces_cum, stacked.labels, stacked.Dist, stacked.info_event, stacked.azimuth, stacked.lg_Stot], set_seed=set_seed)
     
-    np.savez_compressed(output_dir+dataset_name+'.npz', traces=traces, dist=Dist_norm, Stot=lg_Stot, azimuthSP=azimuth, info_event=info_events, labels=labels)
-    print("File has been created as "+dataset_name+'.npz in '+output_dir)
+    arrays = dict(traces=traces, dist=Dist_norm, Stot=lg_Stot, azimuthSP=azimuth, info_event=info_events, labels=labels)
+    if quantize:
+        arrays = quantize_arrays(arrays)
+
+    if save_format == 'npy':
+        save_npy_dir(output_dir+dataset_name, arrays)
+        print("Files have been created in "+output_dir+dataset_name)
+    else:
+        save = np.savez_compressed if compress else np.savez
+        save(output_dir+dataset_name+'.npz', **arrays)
+        print("File has been created as "+dataset_name+'.npz in '+output_dir)
+
+
+def save_npy_dir(dataset_dir: str, arrays: Dict[str, np.ndarray]) -> None:
+    """
+    Save each array of the data set as a separate .npy file, writing them in parallel.
+
+    Parameters:
+    -----------
+    dataset_dir : str
+        Directory where the .npy files will be saved (created if it doesn't exist).
+    arrays : Dict[str, np.ndarray]
+        Arrays of the data set, each one is saved as <key>.npy.
+
+    Returns:
+    -----------
+    None
+    """
+    os.makedirs(dataset_dir, exist_ok=True)
+    with ThreadPoolExecutor() as executor:
+        futures = [executor.submit(np.save, os.path.join(dataset_dir, key+'.npy'), arr) for key, arr in arrays.items()]
+        for future in futures:
+            future.result()
+
+
+def load_dataset(dataset_dir: str) -> Dict[str, np.ndarray]:
+    """
+    Load a data set saved as one .npy file per array, as read-only memory-mapped arrays.
+
+    Parameters:
+    -----------
+    dataset_dir : str
+        Directory containing the .npy files.
+
+    Returns:
+    -----------
+    Dict[str, np.ndarray]
+        Memory-mapped arrays, keyed by the name of the .npy file (without extension).
+    """
+    return {filename[:-len('.npy')]: np.load(os.path.join(dataset_dir, filename), mmap_mode='r')
+            for filename in sorted(os.listdir(dataset_dir)) if filename.endswith('.npy')}
 
 
 
 def load_npz_file(output_dir: str, dataset_name: str)-> None:
     """
-    Load the compressed NumPy file and check its content.
+    Check the content of the NumPy file, reading only the header of each array.
 
     Parameters:
     -----------
@@ -108,27 +176,94 @@ def load_npz_file(output_dir: str, dataset_name: str)-> None:
     -----------
     None
     """
-    # Load the compressed NumPy file
-    data = np.load(output_dir + dataset_name+'.npz')
+    print("Try to load it and check the content...")
+    # Read shape and dtype of each array from its .npy header, without loading the data
+    headers = {}
+    with zipfile.ZipFile(output_dir + dataset_name+'.npz') as zf:
+        for member in zf.namelist():
+            with zf.open(member) as fp:
+                version = np.lib.format.read_magic(fp)
+                if version == (1, 0):
+                    shape, _, dtype = np.lib.format.read_array_header_1_0(fp)
+                else:
+                    shape, _, dtype = np.lib.format.read_array_header_2_0(fp)
+            headers[member[:-len('.npy')]] = (shape, dtype)
 
+    traces_scale = None
+    if 'traces_scale' in headers:
+        with np.load(output_dir + dataset_name+'.npz') as data:
+            traces_scale = data['traces_scale']
+    print_dataset_content(headers, traces_scale)
+
+
+def load_npy_dir(output_dir: str, dataset_name: str)-> None:
+    """
+    Check the content of a data set saved as one .npy file per array.
+
+    Parameters:
+    -----------
+    output_dir : str
+        Directory path where the dataset directory is located.
+    dataset_name : str
+        Name of the dataset directory.
+
+    Returns:
+    -----------
+    None
+    """
     print("Try to load it and check the content...")
-    # Check the keys of the loaded data
-    print(" Keys in the compressed file:", data.files)
+    data = load_dataset(output_dir + dataset_name)
+    headers = {key: (arr.shape, arr.dtype) for key, arr in data.items()}
+    print_dataset_content(headers, data.get('traces_scale'))
+
+
+def check_dataset(output_dir: str, dataset_name: str, save_format: str = 'npz')-> None:
+    """
+    Check the content of the data set, saved with the given format.
+
+    Parameters:
+    -----------
+    output_dir : str
+        Directory path where the dataset is located.
+    dataset_name : str
+        Name of the dataset.
+    save_format : str, optional
+        Format used by merge_and_shuffle ('npz' or 'npy'). Default is 'npz'.
+
+    Returns:
+    -----------
+    None
+    """
+    if save_format == 'npy':
+        load_npy_dir(output_dir, dataset_name)
+    else:
+        load_npz_file(output_dir, dataset_name)
 
-    # Access individual arrays by their keys
-    traces = data['traces']
-    dist = data['dist']
-    Stot = data['Stot']
-    azimuthSP = data['azimuthSP']
-    info_event = data['info_event']
-    labels = data['labels']
+
+def print_dataset_content(headers: Dict[str, tuple], traces_scale=None) -> None:
+    """
+    Print keys and shapes of the arrays of the data set.
+
+    Parameters:
+    -----------
+    headers : Dict[str, tuple]
+        (shape, dtype) of each array of the data set.
+    traces_scale : float, optional
+        Scale factor of the quantized traces, if any.
+
+    Returns:
+    -----------
+    None
+    """
+    # Check the keys of the loaded data
+    print(" Keys in the data set:", list(headers))
 
     print(" Shapes of the arrays:")
-    print(" Traces:", traces.shape)
-    print(" Dist:", dist.shape)
-    print(" Stot:", Stot.shape)
-    print(" AzimuthSP:", azimuthSP.shape)
-    print(" Info_event:", info_event.shape)
-    print(" Labels:", labels.shape)
-
-    data.close()
\ No newline at end of file
+    print(" Traces:", headers['traces'][0])
+    print(" Dist:", headers['dist'][0])
+    print(" Stot:", headers['Stot'][0])
+    print(" AzimuthSP:", headers['azimuthSP'][0])
+    print(" Info_event:", headers['info_event'][0])
+    print(" Labels:", headers['labels'][0])
+    if traces_scale is not None:
+        print(" Traces are quantized to", headers['traces'][1], "with scale", traces_scale)
@@ -5,71 +5,136 @@ Photon search with a CNN
 """
 
 
+import argparse
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import utils, plots, create_dataset
 
-def main():
-    if len(sys.argv) != 2:
-        print("Usage: python main.py <config_file>")
-        sys.exit(1)
+def read_and_process(input_file, theta_cut, label):
+    """
+    Read the tree contained in a .root file and process it, in chunks of events.
+
+    Parameters:
+    input_file (str): The path to the ROOT file.
+    theta_cut (bool): if true only events with theta < 60° are selected.
+    label (int): Label assigned to the events in the file (0 background, 1 signal).
+
+    Returns:
+    ProcessedData: An instance of ProcessedData containing processed data arrays.
+    """
+    return utils.read_and_process_tree(input_file, theta_cut, label)   # read and modify the tree content, one chunk at a time
+
+def plot_particle(input_file, output_file, theta_cut):
+    """
+    Read and process a single .root file and create the plots to explore it.
+
+    Parameters:
+    input_file (str): The path to the ROOT file.
+    output_file (str): The path to the output directory.
+    theta_cut (bool): if true only events with theta < 60° are selected.
+
+    Returns:
+    None
+    """
+    data = utils.read_tree(input_file) #read the tree content
+    proc_data = utils.process_data(data, theta_cut)   # modify the tree content
+    particle_name = utils.extract_particle_name(input_file)
+    plots.plot_all(output_file, particle_name, data.traces, proc_data)
 
-    config_file = sys.argv[1]
-    config_type = utils.read_config_type(config_file)
 
-    if config_type == "plot":
-        print("A single .root file is given as input. Plots will be created to explore it.")
-        input_file, output_file, theta_cut = utils.read_config_plot(config_file)
+def handle_plot(config_file):
+    """
+    Create the plots to explore one or more .root files (configuration file of type "plot").
+
+    Parameters:
+    config_file (str): The path to the JSON configuration file.
+
+    Returns:
+    None
+    """
+    input_files, output_file, theta_cut = utils.read_config_plot(config_file)
+    if isinstance(input_files, str):
+        input_files = [input_files]
+    print(str(len(input_files))+" .root file(s) given as input. Plots will be created to explore them.")
+    for input_file in input_files:
         print("\tInput file is "+input_file)
-        print("\tOutput directory is "+output_file)
-        data = utils.read_tree(input_file) #read the tree content
-        proc_data = utils.process_data(data, theta_cut)   # modify the tree content
-        particle_name = utils.extract_particle_name(input_file)
-        #Plots
-        plots.plot_energy_distributions(output_file, proc_data.lgE_MC, proc_data.lgE, particle_name)
-        plots.plot_S1000_vs_theta(output_file, proc_data.theta, proc_data.lg_S1000, particle_name)
-        plots.plot_nstat_distribution(output_file, proc_data.Nstat, particle_name)
-        plots.plot_hottest_stations(output_file, proc_data.Dist, particle_name)
-        plots.plot_theta_distribution(proc_data.theta, output_file, particle_name)
-        plots.plot_traces(data.traces, proc_data.traces_cum, output_file, particle_name)
-        plots.plot_Stot_for3stations(output_file, proc_data.lg_Stot, particle_name)        
-    elif config_type == "dataset":
-        print("Two .root files are given as input.")
-        print("The data set with signal and background events will be created")
-        input_file1, input_file2, output_dir, dataset_name, theta_cut = utils.read_config_dataset(config_file)
-        print("File 1 is ",input_file1)
-        print("File 2 is ",input_file2)
-        data1 = utils.read_tree(input_file1) #read the tree content
-        data2 = utils.read_tree(input_file2) #read the tree content
-        proc_data1 = utils.process_data(data1, theta_cut, 1)   # modify the tree content
-        proc_data2 = utils.process_data(data2, theta_cut, 0)   # modify the tree content
-        preprocessed_data = []
-        preprocessed_data.append(proc_data1)
-        preprocessed_data.append(proc_data2)
-
-        create_dataset.merge_and_shuffle(output_dir,dataset_name,preprocessed_data)
-        create_dataset.load_npz_file(output_dir, dataset_name)   #to check if it worked
-
-    elif config_type == "onepart_dataset":
-        print("One .root file is given as input.")
-        input_file, output_dir, dataset_name, theta_cut, label = utils.read_config_onepart_dataset(config_file)
-        print("File is ",input_file)
-        print("The data set will be created and the events will be labelled as "+ str(label)+".")
-        data = utils.read_tree(input_file) #read the tree content
-        proc_data = utils.process_data(data, theta_cut, label)   # modify the tree content
-        preprocessed_data = []
-        preprocessed_data.append(proc_data)
-
-        create_dataset.merge_and_shuffle(output_dir,dataset_name,preprocessed_data)
-        create_dataset.load_npz_file(output_dir, dataset_name)   #to check if it worked
-
-        
-    else:
+    print("\tOutput directory is "+output_file)
+
+    if len(input_files) == 1:
+        plot_particle(input_files[0], output_file, theta_cut)
+        return
+    # the particles are independent: each one is read, processed and plotted in its own process
+    with ProcessPoolExecutor(max_workers=min(len(input_files), os.cpu_count())) as executor:
+        futures = [executor.submit(plot_particle, input_file, output_file, theta_cut) for input_file in input_files]
+        for future in futures:
+            future.result()
+
+
+def handle_dataset(config_file):
+    """
+    Create the data set with signal and background events from two .root files (configuration file of type "dataset").
+
+    Parameters:
+    config_file (str): The path to the JSON configuration file.
+
+    Returns:
+    None
+    """
+    print("Two .root files are given as input.")
+    print("The data set with signal and background events will be created")
+    input_file1, input_file2, output_dir, dataset_name, theta_cut, quantize, save_format = utils.read_config_dataset(config_file)
+    print("File 1 is ",input_file1)
+    print("File 2 is ",input_file2)
+    # read and process the two files concurrently (uproot releases the GIL while decompressing)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future1 = executor.submit(read_and_process, input_file1, theta_cut, 1)
+        future2 = executor.submit(read_and_process, input_file2, theta_cut, 0)
+        preprocessed_data = [future1.result(), future2.result()]
+
+    create_dataset.merge_and_shuffle(output_dir,dataset_name,preprocessed_data, quantize=quantize, save_format=save_format)
+    create_dataset.check_dataset(output_dir, dataset_name, save_format)   #to check if it worked
+
+
+def handle_onepart_dataset(config_file):
+    """
+    Create the data set from a single .root file (configuration file of type "onepart_dataset").
+
+    Parameters:
+    config_file (str): The path to the JSON configuration file.
+
+    Returns:
+    None
+    """
+    print("One .root file is given as input.")
+    input_file, output_dir, dataset_name, theta_cut, label, quantize, save_format = utils.read_config_onepart_dataset(config_file)
+    print("File is ",input_file)
+    print("The data set will be created and the events will be labelled as "+ str(label)+".")
+    preprocessed_data = [read_and_process(input_file, theta_cut, label)]
+
+    create_dataset.merge_and_shuffle(output_dir,dataset_name,preprocessed_data, quantize=quantize, save_format=save_format)
+    create_dataset.check_dataset(output_dir, dataset_name, save_format)   #to check if it worked
+
+
+HANDLERS = {
+    "plot": handle_plot,
+    "dataset": handle_dataset,
+    "onepart_dataset": handle_onepart_dataset,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Explore the simulations or create the data set for the CNN.")
+    parser.add_argument("config_file", help="JSON configuration file (config_type: " + ", ".join(HANDLERS) + ")")
+    args = parser.parse_args()
+
+    config_type = utils.read_config_type(args.config_file)
+    handler = HANDLERS.get(config_type)
+    if handler is None:
         print("Unsupported config file type.")
         sys.exit(1)
-
-    
-    
+    handler(args.config_file)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
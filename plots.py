@@ -6,13 +6,91 @@ Photon search with a CNN
 
 
 import os
+import matplotlib
+matplotlib.use('Agg')   # plots are only saved to file, no interactive backend is needed
 import matplotlib.pyplot as plt
 import numpy as np
+try:
+    from fast_histogram import histogram1d, histogram2d
+except ImportError:   # fall back to NumPy, slower for large arrays
+    histogram1d = histogram2d = None
+
+_created_dirs = set()
+THETA_MAX_RAD = np.pi * 75 / 180   # upper edge of the zenith angle histogram
+ENERGY_BINS = np.linspace(17.7, 19.5, 19)   # edges of the energy histograms, log10(E/eV)
+
+def _ensure_dir(output_dir):
+    """
+    Create the output directory if it doesn't exist, only once per directory.
+
+    Parameters:
+    output_dir (str): Directory where the plots will be saved.
+
+    Returns:
+    None
+    """
+    if output_dir not in _created_dirs:
+        os.makedirs(output_dir, exist_ok=True)
+        _created_dirs.add(output_dir)
+
+def _data_range(*arrays):
+    """
+    Range covered by the given arrays, as used by matplotlib for automatic binning.
+
+    Parameters:
+    arrays (np.ndarray): Arrays to be histogrammed on common bins.
+
+    Returns:
+    tuple: (min, max) of all the arrays (widened by 0.5 if all values are equal).
+    """
+    lo = min(np.min(arr) for arr in arrays)
+    hi = max(np.max(arr) for arr in arrays)
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5
+    return lo, hi
+
+def _histogram1d(x, bins, range):
+    """
+    Histogram of x in regular bins, with fast-histogram if available.
+
+    Parameters:
+    x (np.ndarray): Values to be histogrammed.
+    bins (int): Number of bins.
+    range (tuple): Lower and upper edge of the histogram (the upper edge is included).
+
+    Returns:
+    tuple: counts (np.ndarray) and bin edges (np.ndarray).
+    """
+    edges = np.linspace(range[0], range[1], bins + 1)
+    if histogram1d is None:
+        counts, _ = np.histogram(x, bins=bins, range=range)
+    else:
+        counts = histogram1d(x, bins=bins, range=(range[0], np.nextafter(range[1], np.inf)))
+    return counts, edges
+
+def _histogram2d(x, y, bins, range):
+    """
+    2D histogram of (x, y) in regular bins, with fast-histogram if available.
+
+    Parameters:
+    x (np.ndarray): Values along the first axis.
+    y (np.ndarray): Values along the second axis.
+    bins (int): Number of bins along each axis.
+    range (list): [[xmin, xmax], [ymin, ymax]] (upper edges included).
+
+    Returns:
+    np.ndarray: counts, with shape (bins, bins) and x along the first axis.
+    """
+    if histogram2d is None:
+        counts, _, _ = np.histogram2d(x, y, bins=bins, range=range)
+    else:
+        counts = histogram2d(x, y, bins=bins, range=[(lo, np.nextafter(hi, np.inf)) for lo, hi in range])
+    return counts
 
 def plot_energy_distributions(output_dir, lgE_MC, lgE, particle_name):
     """
     Plots energy distributions for Monte Carlo and reconstructed energy, 
-    along with a scatter plot comparing the two energies.
+    along with a density plot comparing the two energies.
 
     Parameters:
     output_dir (str): Directory where the plot will be saved.
@@ -23,15 +101,24 @@ def plot_energy_distributions(output_dir, lgE_MC, lgE, particle_name):
     Returns:
     None
     """
+    # Create the output directory if it doesn't exist
+    _ensure_dir(output_dir)
+
     fig, ax = plt.subplots(1, 2, figsize=(10, 5), sharex=True)
     
-    _, bins, _ = ax[1].hist(lgE, range=(17.7, 19.5), bins=18, rwidth=0.95, color="orange", ec="black", zorder=4, label=particle_name)
+    # Both energies are binned on the same edges
+    counts = _histogram1d(lgE, bins=len(ENERGY_BINS)-1, range=(ENERGY_BINS[0], ENERGY_BINS[-1]))[0]
+    counts_MC = _histogram1d(lgE_MC, bins=len(ENERGY_BINS)-1, range=(ENERGY_BINS[0], ENERGY_BINS[-1]))[0]
+    bin_centers = 0.5*(ENERGY_BINS[1:]+ENERGY_BINS[:-1])
+    bar_widths = 0.95*np.diff(ENERGY_BINS)
+
+    ax[1].bar(bin_centers, counts, width=bar_widths, color="orange", ec="black", zorder=4, label=particle_name)
     ax[1].set_title("$E_{SD}$ distribution", fontsize=16)
     ax[1].grid(zorder=0)
     ax[1].set_ylabel('#', fontsize=13)
     ax[1].set_xlabel('$log_{10}(E/eV)$', fontsize=13)
 
-    ax[0].hist(lgE_MC, bins, rwidth=0.95, color="orange", ec="black", zorder=5, label=particle_name, linestyle=('solid')) 
+    ax[0].bar(bin_centers, counts_MC, width=bar_widths, color="orange", ec="black", zorder=5, label=particle_name, linestyle=('solid'))
     ax[0].set_title("$E_{MC}$ distribution", fontsize=16)
     ax[0].grid(zorder=0)
     ax[0].set_ylabel('#', fontsize=13)
@@ -39,21 +126,18 @@ def plot_energy_distributions(output_dir, lgE_MC, lgE, particle_name):
     
     plt.tight_layout()
     
-    # Create the output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
-    
     # Save the plot in the output directory with the provided filename
     filename = f"{particle_name}_energy_distribution.pdf"  # Adjust the filename as needed
     output_path = os.path.join(output_dir, filename)
     fig.savefig(output_path)
+    plt.close(fig)
 
-    # Plot scatter plot comparing MC and reconstructed energies
+    # Plot the density of events comparing MC and reconstructed energies
     fig2, ax2 = plt.subplots(figsize=(8, 6))
-    lims = [
-        np.min([np.min([lgE_MC, lgE])]),  # min of both axes
-        np.max([np.max([lgE_MC, lgE])]),  # max of both axes
-    ]
-    ax2.scatter(lgE_MC, lgE, s=1, color='darkgreen') 
+    lims = list(_data_range(lgE_MC, lgE))  # min and max of both axes
+    # binned once and drawn as an image, the cost does not depend on the number of events
+    counts = _histogram2d(lgE_MC, lgE, bins=400, range=[lims, lims])
+    ax2.imshow(np.log1p(counts).T, origin='lower', extent=[*lims, *lims], aspect='auto', interpolation='nearest', cmap='Greens')
     ax2.grid(zorder=0)
     ax2.plot(lims, lims, color='k')
     ax2.set_ylabel('$\log_{10}(E_{SD}/\mathrm{eV})$', fontsize=13)
@@ -62,13 +146,11 @@ def plot_energy_distributions(output_dir, lgE_MC, lgE, particle_name):
 
     plt.tight_layout()
     
-    # Create the output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
-    
     # Save the plot in the output directory with the provided filename
     filename = f"{particle_name}_energy_comparison.pdf"  # Adjust the filename as needed
     output_path = os.path.join(output_dir, filename)
-    fig2.savefig(output_path)
+    fig2.savefig(output_path, dpi=150)
+    plt.close(fig2)
 
 
 
@@ -89,7 +171,9 @@ def plot_S1000_vs_theta(output_dir, theta, lg_S1000, particle_name):
     fig, ax = plt.subplots(figsize=(8, 6))
 
     ax.set_title(particle_name+" distribution", fontsize=15)
-    _, binsx, binsy, im = ax.hist2d(theta, lg_S1000, bins=100, cmap='cividis')
+    range_theta, range_S1000 = _data_range(theta), _data_range(lg_S1000)
+    counts = _histogram2d(theta, lg_S1000, bins=100, range=[range_theta, range_S1000])
+    im = ax.imshow(counts.T, origin='lower', extent=[*range_theta, *range_S1000], aspect='auto', interpolation='nearest', cmap='cividis')
     ax.set_ylabel('$log_{10}(S1000/\mathrm{VEM})$', fontsize=13)
     ax.set_xlabel('$\\theta$ (°)', fontsize=13)
 
@@ -97,12 +181,13 @@ def plot_S1000_vs_theta(output_dir, theta, lg_S1000, particle_name):
     plt.tight_layout()
     
     # Create the output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
+    _ensure_dir(output_dir)
     
     # Save the plot in the output directory with the provided filename
     filename = f"{particle_name}_S1000_vs_theta.pdf"  # Adjust the filename as needed
     output_path = os.path.join(output_dir, filename)
     fig.savefig(output_path, bbox_inches='tight')
+    plt.close(fig)
 
 
 
@@ -120,21 +205,21 @@ def plot_nstat_distribution(output_dir, Nstat, particle_name):
     None
     """
     fig, ax = plt.subplots()
-    Nstat_val = 10**Nstat
-    bin_edges = np.linspace(0, 20, num=21)  # 21 edges for 20 bins
-    _, bins, _ = ax.hist(Nstat_val, bins=bin_edges, rwidth=0.95, color="lightblue", ec="blue", zorder=4, label='All')
+    counts, bins = _histogram1d(Nstat, bins=20, range=(0, 20))  # 21 edges for 20 bins
+    ax.bar(0.5*(bins[1:]+bins[:-1]), counts, width=0.95, color="lightblue", ec="blue", zorder=4, label='All')
     ax.set_title("Number of Triggered Stations", fontsize=16)
     ax.grid(zorder=0)
     ax.set_ylabel('Number of Events', fontsize=13)
     ax.set_xlabel('$N_{stat}$', fontsize=13)
     ax.set_xticks(np.arange(min(bins), max(bins)+1, 1))
     # Create the output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
+    _ensure_dir(output_dir)
     
     # Save the plot in the output directory with the provided filename
     filename = f"{particle_name}_Nstat_distribution.pdf"  # Adjust the filename as needed
     output_path = os.path.join(output_dir, filename)
     fig.savefig(output_path)
+    plt.close(fig)
 
 
 
@@ -143,15 +228,20 @@ def plot_hottest_stations(output_dir, Dist_norm, particle_name):
     Plot the distance distribution of the three hottest stations from the shower core.
 
     Parameters:
+    output_dir (str): Directory where the plot will be saved.
     Dist_norm (np.ndarray): Array containing normalized distances of the hottest stations.
+    particle_name (str): Name of the particle being analyzed.
 
     Returns:
     None
     """
-    plt.figure()
-    plt.hist(Dist_norm[:, 0], alpha=0.7, ec="blue", zorder=4, label='Hottest station')
-    plt.hist(Dist_norm[:, 1], alpha=0.5, ec="orange", zorder=5, label='Second-hottest station')
-    _, bins, _ = plt.hist(Dist_norm[:, 2], alpha=0.2, ec="green", zorder=8, label='Third-hottest station')
+    fig = plt.figure()
+    # The three stations are binned on common edges
+    stations_range = _data_range(Dist_norm[:, 0], Dist_norm[:, 1], Dist_norm[:, 2])
+    labels = ('Hottest station', 'Second-hottest station', 'Third-hottest station')
+    for num_stat, (label, alpha, ec, zorder) in enumerate(zip(labels, (0.7, 0.5, 0.2), ("blue", "orange", "green"), (4, 5, 8))):
+        counts, bins = _histogram1d(Dist_norm[:, num_stat], bins=10, range=stations_range)
+        plt.stairs(counts, bins, fill=True, facecolor=f"C{num_stat}", alpha=alpha, ec=ec, zorder=zorder, label=label)
     
     plt.title("Distance of the three hottest stations from the shower core")
     plt.grid(zorder=0)
@@ -160,12 +250,13 @@ def plot_hottest_stations(output_dir, Dist_norm, particle_name):
     plt.legend()
 
     # Create the output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
+    _ensure_dir(output_dir)
     
     # Save the plot in the output directory with the provided filename
     filename = f"{particle_name}_stations_distance.pdf"  # Adjust the filename as needed
     output_path = os.path.join(output_dir, filename)
     plt.savefig(output_path)
+    plt.close(fig)
 
 
 def plot_Stot_for3stations(output_dir, Stot, particle_name):
@@ -180,33 +271,39 @@ def plot_Stot_for3stations(output_dir, Stot, particle_name):
     Returns:
     None
     """
+    # Create the output directory if it doesn't exist
+    _ensure_dir(output_dir)
+
     n_stat = 3 
+    Stot_arr = np.asarray(Stot)
+    Stot_min = np.nanmin(Stot_arr[:, :n_stat], axis=0)
+    Stot_max = np.nanmax(Stot_arr[:, :n_stat], axis=0)
+    fig = plt.figure()   # the same figure is cleared and reused for each station
     for num_stat in range(0,n_stat):    #loop over the nth hottest stations
-        fig, ax = plt.subplots()
+        fig.clf()
+        ax = fig.add_subplot()
         props = dict(boxstyle='round', facecolor='wheat', alpha=0.6)
-        Stot_stat = np.array([Stot_val for Stot_val in Stot])[:,num_stat]
-        _, bins, _ = ax.hist(Stot_stat,range=(np.nanmin(Stot_stat), np.nanmax(Stot_stat)), rwidth = 0.95, ec=(210/255,105/255,30/255,1), facecolor=(255/255,228/255,196/255,0.6), zorder=6, label=particle_name)
+        Stot_stat = Stot_arr[:, num_stat]
+        _, bins, _ = ax.hist(Stot_stat,range=(Stot_min[num_stat], Stot_max[num_stat]), rwidth = 0.95, ec=(210/255,105/255,30/255,1), facecolor=(255/255,228/255,196/255,0.6), zorder=6, label=particle_name)
         ax.set_title("Total signal for station {0}".format(num_stat+1), fontsize=15)
         ax.set_ylabel('#', fontsize=13)
         ax.set_xlabel('$S_{tot}^{norm}$', fontsize=12)
         ax.grid(zorder=0)
         ax.text(0.3, 0.65, particle_name+' : $\mu$={0}, $\sigma={1}$'.format(round(Stot_stat.mean(),2), round(Stot_stat.std(),2)), horizontalalignment='left', verticalalignment='center', transform=ax.transAxes, zorder=7, bbox=props, fontsize=12) 
         
-        # Create the output directory if it doesn't exist
-        os.makedirs(output_dir, exist_ok=True)
-        
         # Save the plot in the output directory with the provided filename
         filename = f"{particle_name}"  # Adjust the filename as needed
         output_path = os.path.join(output_dir, filename)
         fig.savefig(output_path+'_Stot_stat_{0}.pdf'.format(num_stat), bbox_inches='tight')
+    plt.close(fig)
 
 
-def plot_theta_distribution(theta, output_dir, particle_name):
+def plot_theta_distribution(theta_rad, output_dir, particle_name):
     """
     Plot the zenith angle distribution for a single particle.
 
     Parameters:
-    theta (np.ndarray): Array containing zenith angles.
+    theta_rad (np.ndarray): Array containing zenith angles in radians.
     output_dir (str): Directory where the plot will be saved.
     particle_name (str): Name of the particle being analyzed.
 
@@ -214,7 +311,7 @@ def plot_theta_distribution(theta, output_dir, particle_name):
     None
     """
     fig, ax = plt.subplots()
-    ax.hist(np.radians(theta),bins=75, range=(0, np.radians(75)), rwidth=0.95, color="lightblue", ec="blue", zorder=4)
+    ax.hist(theta_rad,bins=75, range=(0, THETA_MAX_RAD), rwidth=0.95, color="lightblue", ec="blue", zorder=4)
 
     def deg2rad(x):
         return x * np.pi / 180
@@ -230,12 +327,13 @@ def plot_theta_distribution(theta, output_dir, particle_name):
     ax.set_xlabel('$\\theta$ (rad)')
     
     # Create the output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
+    _ensure_dir(output_dir)
     
     # Save the plot in the output directory with the provided filename
     filename = f"{particle_name}_theta_distribution.pdf"  # Adjust the filename as needed
     output_path = os.path.join(output_dir, filename)
     fig.savefig(output_path, bbox_inches='tight')
+    plt.close(fig)
 
 
 
@@ -255,24 +353,46 @@ def plot_traces(traces, cum_traces, output_dir, particle_name):
     fig, axes = plt.subplots(1, 2, figsize=(12, 6))
 
     # Plot traces for the first particle
-    selected_indices = np.random.choice(np.arange(cum_traces.shape[0]), size=100, replace=False)
-    for idx in selected_indices:
-        axes[0].plot(traces[idx, 0, :], label=f'Trace {idx}')
+    selected_indices = np.random.default_rng().choice(cum_traces.shape[0], size=100, replace=False)
+    axes[0].plot(traces[selected_indices, 0, :].T, linewidth=0.5)
     axes[0].set_title("Traces for " + particle_name+"s")
     axes[0].set_ylabel('VEM')
     axes[0].set_xlabel('Time bin')
 
     # Plot traces for the second particle
-    for idx in selected_indices:
-        axes[1].plot(cum_traces[idx, 0, :], label=f'Trace {idx}')
+    axes[1].plot(cum_traces[selected_indices, 0, :].T, linewidth=0.5)
     axes[1].set_title("Cumulative traces for " + particle_name +"s")
     axes[1].set_ylabel('VEM')
     axes[1].set_xlabel('Time bin')
     
     # Create the output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
+    _ensure_dir(output_dir)
     
     # Save the plot in the output directory with the provided filename
     filename = f"{particle_name}_traces.pdf"  # Adjust the filename as needed
     output_path = os.path.join(output_dir, filename)
-    fig.savefig(output_path, bbox_inches='tight')
\ No newline at end of file
+    fig.savefig(output_path, bbox_inches='tight')
+    plt.close(fig)
+
+
+
+def plot_all(output_dir, particle_name, traces, proc_data):
+    """
+    Create all the plots to explore the data of a single particle.
+
+    Parameters:
+    output_dir (str): Directory where the plots will be saved.
+    particle_name (str): Name of the particle being analyzed.
+    traces (np.ndarray): Array containing the raw traces for the particle.
+    proc_data (ProcessedData): Processed data of the particle.
+
+    Returns:
+    None
+    """
+    plot_energy_distributions(output_dir, proc_data.lgE_MC, proc_data.lgE, particle_name)
+    plot_S1000_vs_theta(output_dir, proc_data.theta, proc_data.lg_S1000, particle_name)
+    plot_nstat_distribution(output_dir, proc_data.Nstat_linear, particle_name)
+    plot_hottest_stations(output_dir, proc_data.Dist, particle_name)
+    plot_theta_distribution(proc_data.theta_rad, output_dir, particle_name)
+    plot_traces(traces, proc_data.traces_cum, output_dir, particle_name)
+    plot_Stot_for3stations(output_dir, proc_data.lg_Stot, particle_name)
\ No newline at end of file
@@ -5,15 +5,21 @@ Photon search with a CNN
 """
 
 
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+import functools
 import uproot
+import awkward as ak
 import json
 import numpy as np
 import os
 import math
+try:
+    import numexpr as ne
+except ImportError:   # fall back to NumPy, single-threaded
+    ne = None
 #import plots
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class TreeData:
     """
     Represents the data from a single tree.
@@ -44,7 +50,7 @@ class TreeData:
     Nstat: np.ndarray
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ProcessedData:
     """
     Represents processed data from a single tree.
@@ -53,14 +59,16 @@ class ProcessedData:
     lgE_MC (np.ndarray): Processed energy from Monte Carlo simulation.
     lgE (np.ndarray): Processed reconstructed energy.
     Dist (np.ndarray): Normalized distance.
-    traces (np.ndarray): Cumulative traces vector.
+    traces_cum (np.ndarray): Cumulative traces vector (float32).
     ID (np.ndarray): ID from standard deviation.
     t0 (np.ndarray): t0 value.
     theta (np.ndarray): Theta value in degrees.
+    theta_rad (np.ndarray): Theta value in radians.
     lg_Stot (np.ndarray): Processed and rescaled Stot value.
     lg_S1000 (np.ndarray): Processed S1000 value.
     azimuth (np.ndarray): AzimuthSP value in degrees.
     Nstat (np.ndarray): Normalized Nstat value.
+    Nstat_linear (np.ndarray): Number of triggered stations (not log-transformed).
     label (int): label (0 or 1)
     """
     lgE_MC: np.ndarray
@@ -70,31 +78,140 @@ class ProcessedData:
     ID: np.ndarray
     t0: np.ndarray
     theta: np.ndarray
+    theta_rad: np.ndarray
     lg_Stot: np.ndarray
     lg_S1000: np.ndarray
     azimuth: np.ndarray
     Nstat: np.ndarray
+    Nstat_linear: np.ndarray
     label: int
 
+    @classmethod
+    def stack(cls, processed_data_list):
+        """
+        Merge several ProcessedData objects into a single StackedData container.
+
+        The merged arrays are allocated once and each ProcessedData object is visited
+        a single time, copying all its fields into the corresponding slice.
+
+        Parameters:
+        processed_data_list (list): A list of ProcessedData instances.
+
+        Returns:
+        StackedData: An instance of StackedData containing the merged arrays.
+        """
+        n_events = sum(len(data.lgE_MC) for data in processed_data_list)
+        first = processed_data_list[0]
+        stacked = StackedData(
+            traces_cum=np.empty((n_events,) + first.traces_cum.shape[1:] + (1,), dtype=first.traces_cum.dtype),
+            Dist=np.empty((n_events,) + first.Dist.shape[1:] + (1,), dtype=first.Dist.dtype),
+            lg_Stot=np.empty((n_events,) + first.lg_Stot.shape[1:] + (1,), dtype=first.lg_Stot.dtype),
+            azimuth=np.empty((n_events,) + first.azimuth.shape[1:] + (1,), dtype=first.azimuth.dtype),
+            info_event=np.empty((n_events, 3, 1), dtype=np.result_type(first.theta, first.lg_S1000, first.Nstat)),
+            labels=np.empty(n_events, dtype=np.int8)
+        )
+
+        offset = 0
+        for data in processed_data_list:
+            n = len(data.lgE_MC)
+            stacked.traces_cum[offset:offset+n, ..., 0] = data.traces_cum
+            stacked.Dist[offset:offset+n, ..., 0] = data.Dist
+            stacked.lg_Stot[offset:offset+n, ..., 0] = data.lg_Stot
+            stacked.azimuth[offset:offset+n, ..., 0] = data.azimuth
+            stacked.info_event[offset:offset+n, 0, 0] = data.theta
+            stacked.info_event[offset:offset+n, 1, 0] = data.lg_S1000
+            stacked.info_event[offset:offset+n, 2, 0] = data.Nstat
+            stacked.labels[offset:offset+n] = data.label
+            offset += n
 
+        return stacked
 
-def rescale_Stot(x_list, Snorm):
+
+@dataclass(slots=True, frozen=True)
+class StackedData:
     """
-    Rescale Stot values in a list.
+    Represents the processed data of several trees merged together.
+    All arrays except labels have a trailing axis of length 1 (channel axis of the CNN inputs).
+
+    Attributes:
+    traces_cum (np.ndarray): Cumulative traces vector.
+    Dist (np.ndarray): Normalized distance.
+    lg_Stot (np.ndarray): Processed and rescaled Stot value.
+    azimuth (np.ndarray): AzimuthSP value in degrees.
+    info_event (np.ndarray): Event information (theta, lg_S1000, Nstat).
+    labels (np.ndarray): Label of each event (0 or 1), as int8.
+    """
+    traces_cum: np.ndarray
+    Dist: np.ndarray
+    lg_Stot: np.ndarray
+    azimuth: np.ndarray
+    info_event: np.ndarray
+    labels: np.ndarray
+
+
+
+# Number of time bins of the traces used to build the cumulative traces
+TRACE_LENGTH = 150
+
+# Maximum zenith angle of the events kept when the theta selection is enabled
+THETA_CUT_RAD = np.radians(60)
+
+# Name of the branch of the input tree read into each TreeData attribute
+TREE_BRANCHES = {
+    "Ene_MC": "E_MC",
+    "Ene": "E_SD",
+    "Dist": "Dist",
+    "traces": "traces_vec",
+    "ID": "ID_SD",
+    "t0": "t0",
+    "theta": "theta",
+    "Stot": "Stot",
+    "S1000": "Shsize",
+    "azimuth": "azimuthSP",
+    "Nstat": "Nstat",
+}
+
+
+def log10(x):
+    """
+    Base-10 logarithm of an array, evaluated multithreaded with numexpr if available.
 
     Parameters:
-    x_list (list): A list of Stot values.
+    x (np.ndarray): Array of positive values.
+
+    Returns:
+    np.ndarray: Array with the logarithm of the values.
+    """
+    if ne is not None:
+        return ne.evaluate('log10(x)', local_dict={'x': x})
+    return np.log10(x)
+
+
+def rescale_Stot(x, Snorm):
+    """
+    Rescale Stot values.
+
+    Parameters:
+    x (np.ndarray): Array of Stot values.
     Snorm (float): Normalization factor.
 
     Returns:
-    list: A list of rescaled Stot values.
+    np.ndarray: Array of rescaled Stot values.
     """
-    return [np.log10(xi + 1.0) / math.log10(Snorm + 1) for xi in x_list]
+    x = np.asarray(x)
+    inv_norm = 1.0 / math.log10(Snorm + 1.0)
+    if ne is not None:
+        # single multithreaded pass, without the x + 1 temporary
+        return ne.evaluate('log10(x + 1.0) * inv_norm', local_dict={'x': x, 'inv_norm': inv_norm})
+    lg_x = np.add(x, 1.0)   # the only allocation, log10 and scaling are done in place
+    np.log10(lg_x, out=lg_x)
+    lg_x *= inv_norm
+    return lg_x
 
 
 
 
-def process_data(tree_data_input, sel_theta = False, label_val=1, Snorm=100):
+def process_data(tree_data_input, sel_theta = False, label_val=1, Snorm=100, center_Dist=True):
     """
     Process data from a single tree.
 
@@ -103,68 +220,58 @@ def process_data(tree_data_input, sel_theta = False, label_val=1, Snorm=100):
     sel_theta (bool, optional): if true a selection of vertical events is performed (theta < 60°)
     label_val (int, optional): It distinguish between signal (1) and background (0) data
     Snorm (float, optional): Normalization factor for Stot (default is 100).
+    center_Dist (bool, optional): if true the mean of the normalized distance is subtracted (default is True).
+        It is disabled when the tree is processed in chunks, since the mean must be computed over all events.
 
     Returns:
     ProcessedData: An instance of ProcessedData containing processed data arrays.
     """
 
+    if tree_data_input.traces.shape[2] < TRACE_LENGTH:
+        raise ValueError(f"Traces have {tree_data_input.traces.shape[2]} time bins, at least {TRACE_LENGTH} are needed.")
+
     if(sel_theta):
-        # Filter data based on theta
-        filtered_indices = np.where(tree_data_input.theta <= np.radians(60))[0]
-        tree_data = TreeData(
-            Ene_MC=tree_data_input.Ene_MC[filtered_indices],
-            Ene=tree_data_input.Ene[filtered_indices],
-            Dist=tree_data_input.Dist[filtered_indices],
-            traces=tree_data_input.traces[filtered_indices],
-            ID=tree_data_input.ID[filtered_indices],
-            t0=tree_data_input.t0[filtered_indices],
-            theta=tree_data_input.theta[filtered_indices],
-            Stot=tree_data_input.Stot[filtered_indices],
-            S1000=tree_data_input.S1000[filtered_indices],
-            azimuth=tree_data_input.azimuth[filtered_indices],
-            Nstat=tree_data_input.Nstat[filtered_indices]
-        )
+        # Filter data based on theta with a boolean mask
+        # (only the first TRACE_LENGTH bins of the traces are used, the rest is not copied)
+        mask = tree_data_input.theta <= THETA_CUT_RAD
+        tree_data = TreeData(**{field.name: getattr(tree_data_input, field.name)[mask]
+                                for field in fields(TreeData) if field.name != 'traces'},
+                             traces=tree_data_input.traces[mask, :, :TRACE_LENGTH])
     else:
         tree_data = tree_data_input
 
     # Process Nstat
-    Nstat_val = np.array(tree_data.Nstat, dtype=np.float128) #conversion to avoid rounding problems
-    Nstat = np.log10(Nstat_val)
+    Nstat = np.log10(tree_data.Nstat, dtype=np.float128) #computed in float128 to avoid rounding problems, without a converted copy
 
-    lg_Stot = np.array([rescale_Stot(tree_data.Stot, Snorm)])
-    lg_Stot = np.squeeze(lg_Stot)
+    lg_Stot = rescale_Stot(tree_data.Stot, Snorm)
   
     
     # Convert theta to degrees
     theta_deg = np.degrees(tree_data.theta)
     
     # Process S1000
-    lg_S1000 = np.log10(tree_data.S1000)
+    lg_S1000 = log10(tree_data.S1000)
     
     # Process energy (Ene)
-    lgE = np.log10(tree_data.Ene)
+    lgE = log10(tree_data.Ene)
     
     # Process energy from Monte Carlo simulation (Ene_MC)
-    lgE_MC = np.log10(tree_data.Ene_MC)
+    lgE_MC = log10(tree_data.Ene_MC)
     
     # Convert azimuth to degrees
     azimuth_deg = np.degrees(tree_data.azimuth)
     
     # Normalize Dist
-    Dist_1500 = tree_data.Dist / 1500
-    mean = np.mean(Dist_1500)
-    Dist_norm = Dist_1500 - mean
+    Dist_norm = tree_data.Dist / 1500
+    if center_Dist:
+        Dist_norm -= np.mean(Dist_norm)   # in place, no second full-size array
  
     
-    # Create a copy of the traces array to avoid modifying the original data
-    traces = np.copy(tree_data.traces)
-    
-    # Normalize traces
-    traces_cum = traces[:, :, :150]
-    for j, event in enumerate(traces_cum):
-        for i, stat in enumerate(event):
-            stat = np.cumsum(stat)
-            traces_cum[j][i] = stat / np.max(stat)
+    # Normalize traces: cumulative sum of the first TRACE_LENGTH bins, divided by its maximum
+    # (cumsum of the slice is a new float32 array, the original data is not modified)
+    traces_cum = np.cumsum(tree_data.traces[:, :, :TRACE_LENGTH], axis=2, dtype=np.float32)
+    norm = np.max(traces_cum, axis=2, keepdims=True)
+    np.divide(traces_cum, norm, out=traces_cum, where=norm != 0)   # empty traces are left at 0
 
 
     ProcessedTree = ProcessedData(
@@ -175,16 +282,60 @@ def process_data(tree_data_input, sel_theta = False, label_val=1, Snorm=100):
         ID=tree_data.ID,
         t0=tree_data.t0,
         theta=theta_deg,
+        theta_rad=tree_data.theta,
         lg_Stot=lg_Stot,
         lg_S1000=lg_S1000,
         azimuth=azimuth_deg,
         Nstat=Nstat,
+        Nstat_linear=tree_data.Nstat,
         label=label_val
     )
 
     return ProcessedTree
 
 
+def branches_to_tree_data(branches):
+    """
+    Convert the branches read with uproot to a TreeData object.
+
+    Parameters:
+    branches (ak.Array): Record array with the branches listed in TREE_BRANCHES.
+
+    Returns:
+    TreeData: instance of TreeData containing arrays of data extracted from the tree
+    """
+    # jagged branches with a fixed length are made regular and converted to NumPy without going through Python lists
+    return TreeData(**{field: ak.to_numpy(ak.to_regular(branches[branch], axis=None))
+                       for field, branch in TREE_BRANCHES.items()})
+
+
+@functools.lru_cache(maxsize=None)
+def _uproot_executors():
+    """
+    Thread pools shared by all the ROOT files that are read (created on first use).
+
+    Returns:
+    tuple: executors for basket decompression and for interpretation of the arrays.
+    """
+    n_workers = os.cpu_count()
+    return uproot.ThreadPoolExecutor(max_workers=n_workers), uproot.ThreadPoolExecutor(max_workers=n_workers)
+
+
+def open_root_file(file_path):
+    """
+    Open a ROOT file, decompressing and interpreting the baskets in parallel threads.
+
+    Parameters:
+    file_path (str): The path to the ROOT file.
+
+    Returns:
+    uproot.ReadOnlyDirectory: The opened ROOT file.
+    """
+    decompression_executor, interpretation_executor = _uproot_executors()
+    return uproot.open(file_path, decompression_executor=decompression_executor,
+                       interpretation_executor=interpretation_executor)
+
+
 def read_tree(file_path):
     """
     Read data from a ROOT file containing a single tree.
@@ -196,32 +347,76 @@ def read_tree(file_path):
     TreeData: instance of TreeData containing arrays of data extracted from the tree
     """
     # Open the ROOT file
-    file = uproot.open(file_path)
+    file = open_root_file(file_path)
 
     # Access the tree (assuming there's only one tree)
     tree = file[file.keys()[0]]
 
-    # Read branches
-    branches = tree.arrays()
+    # Read only the branches that are stored in TreeData
+    branches = tree.arrays(list(TREE_BRANCHES.values()))
 
     # Create a TreeData object to hold the data
-    tree_data = TreeData(
-        Ene_MC=np.array(branches["E_MC"].tolist()),
-        Ene=np.array(branches["E_SD"].tolist()),
-        Dist=np.array(branches["Dist"].tolist()),
-        traces=np.array(branches["traces_vec"].tolist()),
-        ID=np.array(branches["ID_SD"].tolist()),
-        t0=np.array(branches["t0"].tolist()),
-        theta=np.array(branches["theta"].tolist()),
-        Stot=np.array(branches["Stot"].tolist()),
-        S1000=np.array(branches["Shsize"].tolist()),
-        azimuth=np.array(branches["azimuthSP"].tolist()),
-        Nstat=np.array(branches["Nstat"].tolist())
-    )
+    return branches_to_tree_data(branches)
+
+
+def iterate_tree(file_path, step_size="100 MB"):
+    """
+    Read data from a ROOT file containing a single tree, one chunk of events at a time.
+
+    Parameters:
+    file_path (str): The path to the ROOT file.
+    step_size (int or str, optional): Number of events or memory size of each chunk (default is "100 MB").
+
+    Yields:
+    TreeData: instance of TreeData containing the arrays of a chunk of events
+    """
+    with open_root_file(file_path) as file:
+        # Access the tree (assuming there's only one tree)
+        tree = file[file.keys()[0]]
+        for branches in tree.iterate(list(TREE_BRANCHES.values()), step_size=step_size):
+            yield branches_to_tree_data(branches)
+
+
+def read_and_process_tree(file_path, sel_theta=False, label_val=1, Snorm=100, step_size="100 MB"):
+    """
+    Read and process a ROOT file in chunks, so that only one chunk of raw data is in memory at a time.
+
+    Parameters:
+    file_path (str): The path to the ROOT file.
+    sel_theta (bool, optional): if true a selection of vertical events is performed (theta < 60°)
+    label_val (int, optional): It distinguish between signal (1) and background (0) data
+    Snorm (float, optional): Normalization factor for Stot (default is 100).
+    step_size (int or str, optional): Number of events or memory size of each chunk (default is "100 MB").
+
+    Returns:
+    ProcessedData: An instance of ProcessedData containing processed data arrays of all the events.
+    """
+    chunks = [process_data(tree_data, sel_theta, label_val, Snorm, center_Dist=False)
+              for tree_data in iterate_tree(file_path, step_size)]
+
+    merged = {field.name: np.concatenate([getattr(chunk, field.name) for chunk in chunks])
+              for field in fields(ProcessedData) if field.name != 'label'}
+    # The distance is centered using the mean over all the events
+    merged['Dist'] -= np.mean(merged['Dist'])
+
+    return ProcessedData(label=label_val, **merged)
 
-    return tree_data
 
 
+@functools.lru_cache(maxsize=None)
+def load_config(config_file):
+    """
+    Read and parse a JSON configuration file, only once per file.
+
+    Parameters:
+    config_file (str): The path to the JSON configuration file.
+
+    Returns:
+    dict: The content of the configuration file (shared between calls, not to be modified).
+    """
+    with open(config_file, 'r') as f:
+        return json.load(f)
+
 
 def read_config_plot(config_file):
     """
@@ -232,12 +427,11 @@ def read_config_plot(config_file):
 
     Returns:
     tuple: A tuple containing the input and output file paths:
-        - input_file (str): The path to the input ROOT file.
+        - input_file (str or list): The path to the input ROOT file, or a list of paths (one per particle).
         - output_file (str): The path to the output directory.
         - theta_cut (bool): if true only events with theta < 60° are selected.
     """
-    with open(config_file, 'r') as f:
-        config = json.load(f)
+    config = load_config(config_file)
     return config.get('input_file'), config.get('output_file'), config.get('theta_cut')
 
 
@@ -255,10 +449,11 @@ def read_config_dataset(config_file):
         - output_file (str): The path to the output directory.
 	    - dataset_name (str): The name of the data set file that will be created.
         - theta_cut (bool): if true only events with theta < 60° are selected.
+        - quantize (bool): if true traces are saved as int16 and the other arrays as float16 (default false).
+        - save_format (str): "npz" for a single .npz file (default), "npy" for one .npy file per array.
     """
-    with open(config_file, 'r') as f:
-        config = json.load(f)
-    return config.get('input_file1'), config.get('input_file2'), config.get('output_file'), config.get('dataset_name'), config.get('theta_cut')
+    config = load_config(config_file)
+    return config.get('input_file1'), config.get('input_file2'), config.get('output_file'), config.get('dataset_name'), config.get('theta_cut'), config.get('quantize', False), config.get('save_format', 'npz')
 
 
 def read_config_onepart_dataset(config_file):
@@ -275,10 +470,11 @@ def read_config_onepart_dataset(config_file):
 	    - dataset_name (str): The name of the data set file that will be created.
         - theta_cut (bool): If true only events with theta < 60° are selected.
         - label (int): Label assigned to the events in the file (0 background, 1 signal).
+        - quantize (bool): If true traces are saved as int16 and the other arrays as float16 (default false).
+        - save_format (str): "npz" for a single .npz file (default), "npy" for one .npy file per array.
     """
-    with open(config_file, 'r') as f:
-        config = json.load(f)
-    return config.get('input_file'), config.get('output_file'), config.get('dataset_name'), config.get('theta_cut'), config.get('label')
+    config = load_config(config_file)
+    return config.get('input_file'), config.get('output_file'), config.get('dataset_name'), config.get('theta_cut'), config.get('label'), config.get('quantize', False), config.get('save_format', 'npz')
 
     
 
@@ -294,8 +490,7 @@ def read_config_type(config_file):
     Returns:
     config_type (str): The type of configuration file.
     """
-    with open(config_file, 'r') as f:
-        config = json.load(f)
+    config = load_config(config_file)
     return config.get('config_type')
 
 
@@ -313,16 +508,5 @@ def extract_particle_name(input_file):
     Returns:
     str: The particle name extracted from the input file path.
     """
-    # Split the input file path by "/"
-    parts = input_file.split("/")
-    
-    # Get the last part of the path
-    last_part = parts[-1]
-    
-    # Split the last part by "_"
-    sub_parts = last_part.split("_")
-    
-    # Get the first part after the split
-    particle_name = sub_parts[0]
-    
-    return particle_name
+    # First part of the file name, before the first "_"
+    return os.path.basename(input_file).partition("_")[0]